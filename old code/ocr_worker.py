@@ -0,0 +1,11 @@
+# OCR worker process for vision_app.py. Lives in its own module so the
+# "spawn" start method can import it (the Streamlit script itself can't be).
+
+def ocr_worker(jobs, results):
+    # The tesseract engine is loaded once and reused for every page
+    from tesserocr import PyTessBaseAPI
+    with PyTessBaseAPI(lang="eng") as api:
+        while (job := jobs.get()) is not None:
+            doc_id, i, img = job
+            api.SetImage(img)
+            results.put((doc_id, i, api.GetUTF8Text()))
@@ -1,19 +1,60 @@
+import os
+# One OpenMP thread per tesseract worker, otherwise the parallel OCR pool
+# oversubscribes the CPU and ends up slower than the serial loop
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import streamlit as st
 import ollama
+from ollama import AsyncClient
+import asyncio
+import httpx
+import queue
+import threading
+import PIL
 from PIL import Image
 import io
-import pypdf
-import json
-import os
-import subprocess
+import pypdfium2 as pdfium
+import orjson
+import zstandard as zstd
+import numpy as np
+import re
+import atexit
 import glob
+import sqlite3
+import time
 from datetime import datetime
-import pytesseract 
-from pdf2image import convert_from_bytes
+import multiprocessing as mp
+from ocr_worker import ocr_worker
 
 # --- 1. SYSTEM ARCHITECTURE ---
 SESSIONS_DIR = "sessions"  # Folder to store all chat files
+OLLAMA_HOST = "http://localhost:11434"
+KEEP_ALIVE = -1  # Keep models resident in VRAM between turns
+ZSTD_LEVEL = 3  # Chat file compression level
+ZSTD_COMPACT_EVERY = 8  # Saves (frames) before a chat file is rewritten as one frame
+INDEX_DB = os.path.join(SESSIONS_DIR, "_index.sqlite")  # Sidebar metadata (filename, mtime, label)
+# Pillow-SIMD (drop-in, AVX2 resize/convert/JPEG) tags its versions ".postN":
+#   pip uninstall pillow && CC="cc -mavx2" pip install pillow-simd
+PILLOW_SIMD = "post" in PIL.__version__ or "simd" in PIL.__version__.lower()
 USER_PROFILE = "User: Raul (EE Student, TXST). System: Ship of Theseus (RTX 5080)."
+# First user message in a saved chat (whole JSON string, escapes included)
+_LABEL_RE = re.compile(rb'"role"\s*:\s*"user"\s*,\s*"content"\s*:\s*"((?:[^"\\]|\\.)*)"')
+CONTEXT_BUDGET = 6000  # Approx. tokens sent to ollama per turn (system + document + history)
+# ollama's default num_ctx is smaller than the budget and it truncates from the start
+# (dropping USER_PROFILE), so ask for a window with room for the budget plus the reply
+OLLAMA_OPTIONS = {'num_ctx': 8192}
+EMBED_MODEL = "nomic-embed-text"  # Used to pick relevant document chunks
+CHUNK_SIZE = 500       # Chars per document chunk
+TOP_K = 5              # Chunks sent per turn
+DOC_CACHE_ENTRIES = 4  # Uploaded documents (text + embeddings) kept in server memory
+DOC_FALLBACK_BUDGET = CONTEXT_BUDGET // 2  # Tokens of leading document text sent when retrieval is off
+OCR_DPI = 200          # Render resolution for scanned pages
+OCR_MIN_CHARS = 40     # Pages with less embedded text than this get OCR'd
+OCR_TIMEOUT = 120      # Seconds to wait on an OCR worker before giving up
+IMAGE_MAX_EDGE = 1024  # Uploaded images are downscaled to this before going to llava
+SHOW_LAST = 20         # Messages rendered in the main window by default
+FLUSH_INTERVAL = 0.05  # Seconds between UI repaints while streaming
+FLUSH_TOKENS = 32      # ...or repaint early once this many tokens are pending
 
 if not os.path.exists(SESSIONS_DIR):
     os.makedirs(SESSIONS_DIR)
@@ -39,54 +80,458 @@ st.markdown("""
 
 # --- 2. DATABASE CONTROLLERS ---
 
+@st.cache_resource
+def get_nvml_handle():
+    # NVML is initialised once per process (the script body reruns on every event)
+    # Imported here so a missing pynvml lands in get_vram_usage's fallback like a missing driver
+    import pynvml
+    pynvml.nvmlInit()
+    try:
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+    except Exception:
+        pynvml.nvmlShutdown()  # Not cached on failure, so undo the init before the next retry
+        raise
+    atexit.register(pynvml.nvmlShutdown)
+    return pynvml, handle
+
+@st.cache_data(ttl=1.0)
 def get_vram_usage():
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=memory.used,memory.total', '--format=csv,nounits,noheader'],
-            stdout=subprocess.PIPE, text=True
-        )
-        used, total = map(int, result.stdout.strip().split(','))
-        return used, total
+        nvml, handle = get_nvml_handle()
+        info = nvml.nvmlDeviceGetMemoryInfo(handle)
+        return info.used >> 20, info.total >> 20  # Bytes -> MB
     except:
         return 0, 16384
 
+def open_session(filepath):
+    # Sessions are zstd-compressed JSON Lines (one message per line); every save
+    # appends its own frame, so read across all of them
+    return zstd.ZstdDecompressor().stream_reader(open(filepath, "rb"), read_across_frames=True)
+
+def read_session(filename):
+    # Reopening a chat also compacts it: the per-save frames are too small to compress
+    # well, so if there's more than one frame the file is rewritten as a single frame
+    filepath = os.path.join(SESSIONS_DIR, filename)
+    with open(filepath, "rb") as f:
+        raw = f.read()
+    data = zstd.ZstdDecompressor().stream_reader(io.BytesIO(raw), read_across_frames=True).read()
+    messages = [orjson.loads(line) for line in data.splitlines() if line.strip()]
+    if raw and zstd.frame_content_size(raw) != len(data):
+        write_session(filepath, messages)
+    return messages
+
+def append_messages(filepath, messages):
+    # One compressed frame per save, holding only the new messages (cheap, but small
+    # frames compress poorly; see read_session / save_current_session for compaction)
+    lines = b"".join(orjson.dumps(msg) + b"\n" for msg in messages)
+    with open(filepath, "ab") as f:
+        f.write(zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(lines))
+
+def write_session(filepath, messages):
+    # Whole chat as a single frame, written to a temp file and swapped in atomically
+    lines = b"".join(orjson.dumps(msg) + b"\n" for msg in messages)
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(lines))
+    os.replace(tmp_path, filepath)
+
+def migrate_legacy_sessions():
+    # One-time rewrite of old .json / plain .jsonl chats as .jsonl.zst; returns the old names
+    migrated = []
+    for filepath in glob.glob(os.path.join(SESSIONS_DIR, "*.json")) + glob.glob(os.path.join(SESSIONS_DIR, "*.jsonl")):
+        try:
+            with open(filepath, "rb") as f:
+                raw = f.read()
+            if filepath.endswith(".json"):
+                messages = orjson.loads(raw)
+            else:
+                messages = [orjson.loads(line) for line in raw.splitlines() if line.strip()]
+        except Exception:
+            continue  # Unreadable (e.g. truncated) chat: leave it alone, like the old sidebar did
+        new_path = os.path.splitext(filepath)[0] + ".jsonl.zst"
+        write_session(new_path, messages)
+        stat = os.stat(filepath)
+        os.utime(new_path, (stat.st_atime, stat.st_mtime))  # Keep sidebar ordering
+        os.remove(filepath)
+        migrated.append(os.path.basename(filepath))
+    return migrated
+
+@st.cache_resource
+def get_index():
+    conn = sqlite3.connect(INDEX_DB, check_same_thread=False)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS chats(filename TEXT PRIMARY KEY, mtime REAL, label TEXT)")
+        for legacy in migrate_legacy_sessions():
+            conn.execute("DELETE FROM chats WHERE filename = ?", (legacy,))
+        # Drop rows for chats deleted/renamed on disk
+        known = set()
+        for (filename,) in conn.execute("SELECT filename FROM chats").fetchall():
+            if os.path.exists(os.path.join(SESSIONS_DIR, filename)):
+                known.add(filename)
+            else:
+                conn.execute("DELETE FROM chats WHERE filename = ?", (filename,))
+        # Backfill chats saved before the index existed (one-time cost per file)
+        for filepath in glob.glob(os.path.join(SESSIONS_DIR, "*.jsonl.zst")):
+            filename = os.path.basename(filepath)
+            if filename in known:
+                continue
+            try:
+                label = get_chat_label(filepath)
+            except:
+                label = filename
+            conn.execute("INSERT OR REPLACE INTO chats VALUES(?,?,?)", (filename, os.path.getmtime(filepath), label))
+    return conn
+
+@st.cache_data(ttl=2)
+def list_sessions(limit=50):
+    # Newest first: [(filename, label), ...]
+    return get_index().execute("SELECT filename, label FROM chats ORDER BY mtime DESC LIMIT ?", (limit,)).fetchall()
+
+def forget_session(filename):
+    # Chat file is gone from disk; take it out of the sidebar
+    with get_index() as conn:
+        conn.execute("DELETE FROM chats WHERE filename = ?", (filename,))
+    list_sessions.clear()
+
 def create_new_session():
     # Generate a unique filename based on time
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"chat_{timestamp}.json"
+    filename = f"chat_{timestamp}.jsonl.zst"
     
     # Reset state
     st.session_state["messages"] = []
+    st.session_state["saved_count"] = 0
+    st.session_state["frames"] = 0
     st.session_state["current_file"] = filename
     st.rerun()
 
 def load_session(filename):
-    filepath = os.path.join(SESSIONS_DIR, filename)
-    with open(filepath, "r") as f:
-        st.session_state["messages"] = json.load(f)
+    try:
+        messages = read_session(filename)
+    except FileNotFoundError:
+        forget_session(filename)
+        st.toast(f"{filename} no longer exists")
+        return
+    st.session_state["messages"] = messages
+    st.session_state["saved_count"] = len(st.session_state["messages"])
+    st.session_state["frames"] = 1
     st.session_state["current_file"] = filename
-    st.rerun() # Force reload UI
+    # Used as an on_click callback, so the script reruns right after this anyway
 
 def save_current_session():
     # If no file is selected, create one
     if "current_file" not in st.session_state:
         create_new_session()
         
+    # Append only the messages that aren't on disk yet; every ZSTD_COMPACT_EVERY
+    # saves, rewrite the whole chat as one frame so it actually compresses
     filepath = os.path.join(SESSIONS_DIR, st.session_state["current_file"])
-    with open(filepath, "w") as f:
-        json.dump(st.session_state["messages"], f, indent=2)
+    saved = st.session_state.get("saved_count", 0)
+    if st.session_state.get("frames", 0) >= ZSTD_COMPACT_EVERY:
+        write_session(filepath, st.session_state["messages"])
+        st.session_state["frames"] = 1
+    else:
+        append_messages(filepath, st.session_state["messages"][saved:])
+        st.session_state["frames"] = st.session_state.get("frames", 0) + 1
+    st.session_state["saved_count"] = len(st.session_state["messages"])
+
+    # Keep the sidebar index in sync (label = first user message, cut to 25 chars)
+    filename = st.session_state["current_file"]
+    label = next((m['content'][:25] + "..." for m in st.session_state["messages"] if m['role'] == 'user'), filename)
+    with get_index() as conn:
+        conn.execute("INSERT OR REPLACE INTO chats VALUES(?,?,?)", (filename, time.time(), label))
+    list_sessions.clear()
+
+@st.cache_resource
+def get_pdfium_lock():
+    # PDFium isn't thread-safe; one lock per process (a module-level Lock would be
+    # recreated on every rerun)
+    return threading.Lock()
+
+@st.cache_resource
+def get_ocr_pool():
+    # Persistent OCR processes, started once per app
+    try:
+        import tesserocr  # noqa: F401 -- fail here, not inside every worker
+    except ImportError:
+        raise RuntimeError("OCR needs tesserocr (pip install tesserocr)") from None
+    ctx = mp.get_context("spawn")
+    jobs, results = ctx.Queue(), ctx.Queue()
+    procs = [ctx.Process(target=ocr_worker, args=(jobs, results), daemon=True) for _ in range(os.cpu_count() or 1)]
+    for p in procs:
+        p.start()
+    return jobs, results, procs, threading.Lock()
+
+def reset_ocr_pool(procs):
+    # Tear down a broken pool so the next OCR request starts fresh workers
+    for p in procs:
+        p.terminate()
+    get_ocr_pool.clear()
+
+def ocr_pages(pdf, indices):
+    # Pages are rasterized here one at a time (caller holds the PDFium lock) and handed
+    # to the worker processes. At most 2x workers pages are in flight.
+    # Returns {page index: text} for the requested pages.
+    jobs, results, procs, lock = get_ocr_pool()
+    workers = len(procs)
+    doc_id = time.monotonic_ns()
+    texts = {}
+
+    def collect():
+        # Poll so a dead worker is noticed right away instead of after OCR_TIMEOUT
+        deadline = time.monotonic() + OCR_TIMEOUT
+        while True:
+            try:
+                done_id, i, text = results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [p for p in procs if not p.is_alive()]
+                if dead:
+                    reset_ocr_pool(procs)
+                    raise RuntimeError(f"OCR worker exited (code {dead[0].exitcode}), check the tesseract install")
+                if time.monotonic() > deadline:
+                    reset_ocr_pool(procs)
+                    raise RuntimeError(f"OCR gave no result for {OCR_TIMEOUT}s")
+                continue
+            if done_id == doc_id:  # Skip anything left over from an earlier document
+                texts[i] = text
+                return
+
+    with lock:  # One document at a time, results queue is shared
+        in_flight = 0
+        for i in indices:
+            jobs.put((doc_id, i, pdf[i].render(scale=OCR_DPI / 72, grayscale=True).to_pil()))
+            in_flight += 1
+            if in_flight >= workers * 2:
+                collect()
+                in_flight -= 1
+        for _ in range(in_flight):
+            collect()
+    return texts
+
+@st.cache_data(show_spinner=False, max_entries=DOC_CACHE_ENTRIES)
+def extract_context(file_bytes: bytes, mime: str) -> tuple[str | bytes, bool]:
+    # Cached on the file bytes, so the PDF/OCR pass runs once per document
+    # instead of on every rerun (chat message, button press, sidebar click)
+    if mime == "application/pdf":
+        with get_pdfium_lock():  # All PDFium calls, across every browser session
+            pdf = pdfium.PdfDocument(file_bytes)
+            try:
+                # 1. Try Fast Text Extraction (Digital PDFs), page by page
+                page_texts = [page.get_textpage().get_text_range() for page in pdf]
+
+                # 2. Fallback to OCR only for pages with (almost) no embedded text
+                scanned = [i for i, t in enumerate(page_texts) if len(t.strip()) < OCR_MIN_CHARS]
+                if scanned:
+                    st.warning(f"⚠️ Scan detected on {len(scanned)} page(s). Engaging OCR (Optical Character Recognition)...")
+                    with st.spinner("Compiling pixels to text (This takes CPU power)..."):
+                        for i, t in ocr_pages(pdf, scanned).items():
+                            page_texts[i] = t
+                # Blank line between pages so chunk_text doesn't merge paragraphs across them
+                text = "\n\n".join(page_texts)
+            finally:
+                pdf.close()
+
+        return text, False
+
+    # LLaVa resizes to 336px anyway, so ship a small JPEG instead of the original file
+    image = Image.open(io.BytesIO(file_bytes))
+    # thumbnail() already gives JPEGs a draft() hint (reducing_gap=2.0), so large
+    # JPEGs are decoded at reduced scale without an explicit draft call
+    image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+    if "A" in image.getbands() or "transparency" in image.info:
+        # JPEG has no alpha; flatten onto white so transparent areas don't turn black
+        rgba = image.convert("RGBA")
+        flat = Image.new("RGB", rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        image = flat
+    img_byte_arr = io.BytesIO()
+    image.convert("RGB").save(img_byte_arr, format="JPEG", quality=85, optimize=True)
+    return img_byte_arr.getvalue(), True
+
+@st.cache_resource
+def get_ollama():
+    # One client per process so the connection to ollama is kept alive between turns
+    return ollama.Client(host=OLLAMA_HOST, timeout=httpx.Timeout(None, connect=5.0))
+
+@st.cache_resource
+def get_event_loop():
+    # Long-lived loop for streaming; the async client below is bound to it
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_async_ollama():
+    return AsyncClient(host=OLLAMA_HOST, timeout=httpx.Timeout(None, connect=5.0))
+
+def warm_model(client, model):
+    # Empty prompt = load only, no tokens generated
+    try:
+        client.generate(model=model, prompt="", keep_alive=KEEP_ALIVE, options=OLLAMA_OPTIONS)
+    except Exception:
+        pass  # Real request will surface the error
+
+def stream_chat(model, messages):
+    # Network reads happen on a background event loop; this thread only drains
+    # the queue, so socket recv overlaps with markdown rendering
+    q = queue.Queue()
+    stop = threading.Event()
+
+    async def pump():
+        try:
+            async for chunk in await get_async_ollama().chat(model=model, messages=messages, stream=True, keep_alive=KEEP_ALIVE, options=OLLAMA_OPTIONS):
+                if stop.is_set():
+                    break  # Consumer went away (tab closed / rerun)
+                q.put(chunk)
+        except Exception as e:
+            q.put(e)
+        finally:
+            q.put(None)
+
+    asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while (item := q.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def chunk_text(text, size=CHUNK_SIZE):
+    # PDFium ends lines with \r\n and rarely leaves blank lines, so normalise first
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return pack_pieces(text, ["\n\n", "\n", " "], size)
+
+def pack_pieces(text, seps, size):
+    # Merge pieces split on seps[0] into ~size-char chunks. A piece that's still too
+    # big is split on the next separator (paragraph -> line -> word); only a single
+    # oversized word gets hard-cut.
+    sep, finer = seps[0], seps[1:]
+    chunks = []
+    current = ""
+    for piece in text.split(sep):
+        piece = piece.strip()
+        if not piece:
+            continue
+        if len(piece) > size:
+            if current:
+                chunks.append(current)
+                current = ""
+            if finer:
+                chunks.extend(pack_pieces(piece, finer, size))
+            else:
+                chunks.extend(piece[i:i + size] for i in range(0, len(piece), size))
+            continue
+        if current and len(current) + len(sep) + len(piece) > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}{sep}{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def embed(text):
+    vec = np.asarray(get_ollama().embeddings(model=EMBED_MODEL, prompt=text)['embedding'], dtype='float32')
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+@st.cache_resource(show_spinner="Indexing document...", max_entries=DOC_CACHE_ENTRIES)
+def build_doc_index(text):
+    # Embedded once per document; survives reruns. vecs is None when the embedding
+    # model is unavailable, and that result is cached too so it isn't retried every turn.
+    chunks = chunk_text(text)
+    try:
+        vecs = np.stack([embed(c) for c in chunks]) if chunks else np.empty((0, 0), dtype='float32')
+    except Exception:
+        vecs = None
+    return chunks, vecs
+
+def leading_chunks(chunks, budget):
+    # First chunks of the document that fit in the token budget
+    out = []
+    used = 0
+    for chunk in chunks:
+        used += estimate_tokens(chunk)
+        if used > budget:
+            break
+        out.append(chunk)
+    return "\n\n".join(out)
+
+def retrieve_chunks(text, query, k=TOP_K):
+    # Returns (context, retrieval_ok). Without embeddings only the start of the
+    # document is sent, so it can't crowd USER_PROFILE out of num_ctx.
+    # Short documents go in whole
+    if len(text) <= CHUNK_SIZE * k:
+        return text, True
+    chunks, vecs = build_doc_index(text)
+    if vecs is not None:
+        if len(chunks) <= k:
+            return text, True
+        try:
+            scores = vecs @ embed(query)
+            top = np.argpartition(-scores, k)[:k]
+            return "\n\n".join(chunks[i] for i in sorted(top)), True  # Keep document order
+        except Exception:
+            pass
+    return leading_chunks(chunks, DOC_FALLBACK_BUDGET), False
+
+def estimate_tokens(text):
+    # Cheap ~4 chars/token heuristic, close enough for budgeting
+    return len(text) // 4
+
+def pack_history(messages, budget):
+    # Greedily keep messages newest -> oldest until the budget runs out.
+    # The newest message (the prompt) is always kept.
+    out = []
+    used = 0
+    for msg in reversed(messages):
+        tokens = estimate_tokens(msg['content'])
+        if out and used + tokens > budget:
+            break
+        out.append(msg)
+        used += tokens
+    return list(reversed(out))
+
+def get_chat_label(filepath):
+    # Find a "Name" for the chat (First user message), cut to 25 chars so it fits.
+    # Only the head of the file is scanned; full parse is the fallback.
+    with open_session(filepath) as reader:
+        head = reader.read(1024)
+        m = _LABEL_RE.search(head)
+        if m:
+            return orjson.loads(b'"' + m.group(1) + b'"')[:25] + "..."
+        data = [orjson.loads(line) for line in (head + reader.read()).splitlines() if line.strip()]
+    for msg in data:
+        if msg['role'] == 'user':
+            return msg['content'][:25] + "..."
+    return os.path.basename(filepath)
+
+def render_history(slot, key_suffix=""):
+    # One indexed query instead of opening every chat file in the sessions folder.
+    # Rendered into a placeholder so it can be refreshed without a full rerun
+    # (key_suffix keeps widget keys unique when redrawn in the same run).
+    with slot.container():
+        for filename, chat_label in list_sessions():
+            # Highlight the active chat
+            if filename == st.session_state.get("current_file"):
+                st.info(f"📂 {chat_label}")
+            else:
+                st.button(f"📄 {chat_label}", key=filename + key_suffix, on_click=load_session, args=(filename,))
 
 # --- 3. BOOT SEQUENCE ---
 # If we just opened the app and have no file selected, create a new one
 if "current_file" not in st.session_state:
     # Check if there are existing sessions to load the latest one?
     # For now, let's start fresh or load latest.
-    files = sorted(glob.glob(os.path.join(SESSIONS_DIR, "*.json")), reverse=True)
-    if files:
-        latest_file = os.path.basename(files[0])
+    for latest_file, _ in list_sessions():
+        try:
+            st.session_state["messages"] = read_session(latest_file)
+        except FileNotFoundError:
+            forget_session(latest_file)  # Stale index row, try the next newest
+            continue
         st.session_state["current_file"] = latest_file
-        with open(files[0], "r") as f:
-            st.session_state["messages"] = json.load(f)
+        st.session_state["saved_count"] = len(st.session_state["messages"])
+        st.session_state["frames"] = 1
+        break
     else:
         # Total fresh start
         create_new_session()
@@ -106,32 +551,8 @@ with st.sidebar:
     st.subheader("Recent Sessions")
     
     # --- HISTORY LIST ---
-    # List all .json files in the sessions folder
-    files = sorted(glob.glob(os.path.join(SESSIONS_DIR, "*.json")), reverse=True)
-    
-    for filepath in files:
-        filename = os.path.basename(filepath)
-        
-        # Try to find a "Name" for the chat (First user message)
-        chat_label = filename # Default to date
-        try:
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-                # Find first user message for the title
-                for msg in data:
-                    if msg['role'] == 'user':
-                        # Cut it to 25 chars so it fits
-                        chat_label = msg['content'][:25] + "..."
-                        break
-        except:
-            pass
-
-        # Highlight the active chat
-        if filename == st.session_state.get("current_file"):
-            st.info(f"📂 {chat_label}")
-        else:
-            if st.button(f"📄 {chat_label}", key=filename):
-                load_session(filename)
+    history_slot = st.empty()
+    render_history(history_slot)
 
     st.divider()
     
@@ -139,8 +560,15 @@ with st.sidebar:
     vram_used, vram_total = get_vram_usage()
     st.caption(f"VRAM: {vram_used}MB / {vram_total}MB")
     st.progress(vram_used / vram_total)
+    if not PILLOW_SIMD:
+        st.caption(f"Pillow {PIL.__version__} (no SIMD) - install pillow-simd for faster image resize")
     
     model_choice = st.selectbox("Engine", ["gemma2:27b", "deepseek-r1:14b", "llava"])
+    
+    # Load the weights into VRAM in the background while the user types
+    if st.session_state.get("warm_model") != model_choice:
+        st.session_state["warm_model"] = model_choice
+        threading.Thread(target=warm_model, args=(get_ollama(), model_choice), daemon=True).start()
 
    # --- FILE UPLOAD ---
     uploaded_file = st.file_uploader("Context (PDF/IMG)", type=['jpg', 'png', 'pdf'])
@@ -148,48 +576,34 @@ with st.sidebar:
     file_context = None
     has_image = False
     
-    if uploaded_file.type == "application/pdf":
-            text = ""
-            try:
-                # 1. Try Fast Text Extraction (Digital PDFs)
-                pdf_reader = pypdf.PdfReader(uploaded_file)
-                for page in pdf_reader.pages:
-                    extracted = page.extract_text()
-                    if extracted: text += extracted
-
-                # 2. Fallback to OCR (Scanned PDFs) if text is empty
-                if not text.strip():
-                    st.warning("⚠️ Scan detected. Engaging OCR (Optical Character Recognition)...")
-                    with st.spinner("Compiling pixels to text (This takes CPU power)..."):
-                        # Reset file pointer to start
-                        uploaded_file.seek(0)
-                        # Convert PDF pages to Images
-                        images = convert_from_bytes(uploaded_file.read())
-                        # Read text from each image
-                        for img in images:
-                            text += pytesseract.image_to_string(img)
+    if uploaded_file is not None:
+        try:
+            is_pdf = uploaded_file.type == "application/pdf"
+            with st.spinner("Reading PDF..." if is_pdf else "Preparing image..."):
+                file_context, has_image = extract_context(uploaded_file.getvalue(), uploaded_file.type)
             
-                file_context = text
-                st.success(f"📄 Data Extracted: {len(text)} chars")
+            if has_image:
+                st.image(file_context, width=200)
+            else:
+                st.success(f"📄 Data Extracted: {len(file_context)} chars")
                 
-            except Exception as e:
-                st.error(f"Read Error: {e}")
-
-        else:
-            image = Image.open(uploaded_file)
-            st.image(image, width=200)
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format=image.format)
-            file_context = img_byte_arr.getvalue()
-            has_image = True
+        except Exception as e:
+            st.error(f"Read Error: {e}")
 
 # --- 5. MAIN CHAT WINDOW ---
 
 # Header showing which file we are editing
 st.caption(f"Session ID: {st.session_state['current_file']}")
 
-# Display Messages
-for msg in st.session_state.messages:
+# Display Messages (only the last SHOW_LAST; older ones render on demand)
+older = st.session_state.messages[:-SHOW_LAST]
+recent = st.session_state.messages[-SHOW_LAST:]
+if older and st.toggle(f"Show earlier messages ({len(older)})", key="show_earlier"):
+    for msg in older:
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
+
+for msg in recent:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
@@ -212,32 +626,46 @@ if prompt := st.chat_input("Input..."):
         api_messages = [{'role': 'system', 'content': f"System: {USER_PROFILE}"}]
         
         if file_context and not has_image:
-            api_messages.append({'role': 'system', 'content': f"Document: {file_context}"})
+            # Only the chunks relevant to this prompt, not the whole PDF every turn
+            doc_context, retrieval_ok = retrieve_chunks(file_context, prompt)
+            if not retrieval_ok:
+                st.warning(f"⚠️ Embedding model '{EMBED_MODEL}' unavailable (ollama pull {EMBED_MODEL}). "
+                           "Retrieval is off; only the start of the document is sent.")
+            api_messages.append({'role': 'system', 'content': f"Document: {doc_context}"})
             
-        # Context window (last 10 messages)
-        for msg in st.session_state.messages[-10:]:
+        # Context window (newest messages that fit in what's left of the token budget)
+        history_budget = CONTEXT_BUDGET - sum(estimate_tokens(m['content']) for m in api_messages)
+        for msg in pack_history(st.session_state.messages, history_budget):
             api_messages.append({'role': msg['role'], 'content': msg['content']})
 
         try:
             if has_image and model_choice == "llava":
-                response = ollama.chat(model='llava', messages=[{'role': 'user', 'content': prompt, 'images': [file_context]}])
+                response = get_ollama().chat(model='llava', messages=[{'role': 'user', 'content': prompt, 'images': [file_context]}], keep_alive=KEEP_ALIVE, options=OLLAMA_OPTIONS)
                 full_response = response['message']['content']
                 response_placeholder.markdown(full_response)
             else:
-                stream = ollama.chat(model=model_choice, messages=api_messages, stream=True)
+                stream = stream_chat(model_choice, api_messages)
+                # Repaint in batches (every 50ms or 32 tokens) instead of once per token
+                last_flush = time.monotonic()
+                pending = 0
                 for chunk in stream:
                     if chunk['message']['content']:
                         full_response += chunk['message']['content']
-                        response_placeholder.markdown(full_response + "▌")
+                        pending += 1
+                        now = time.monotonic()
+                        if now - last_flush > FLUSH_INTERVAL or pending > FLUSH_TOKENS:
+                            response_placeholder.markdown(full_response + "▌")
+                            pending = 0
+                            last_flush = now
                 response_placeholder.markdown(full_response)
 
             # 3. Save to Disk
             st.session_state.messages.append({"role": "assistant", "content": full_response})
             save_current_session()
             
-            # Rerun occasionally to update sidebar title if it was the first message
+            # Redraw just the history list so the new chat's title shows up
             if len(st.session_state.messages) <= 2:
-                st.rerun()
+                render_history(history_slot, key_suffix="#live")
 
         except Exception as e:
             st.error(f"Error: {e}")
\ No newline at end of file